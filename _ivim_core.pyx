@@ -0,0 +1,46 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""Compiled residual and Jacobian of the IVIM kurtosis model"""
+from libc.math cimport exp
+
+
+def ivim_residual_jac(const double[::1] params, const float[::1] b,
+                      const double[::1] signal, double K,
+                      double[::1] resid_out, double[:, ::1] jac_out):
+    """Residual of the IVIM model and its Jacobian computed in a single pass
+    over the bvalues.
+    Parameters
+    ----------
+    params : array
+        An array of IVIM parameters - [S0, f, D_star, D]
+    b : array, float32
+        The bvalues.
+    signal : array
+        Array containing the actual signal values.
+    K : float
+        The kurtosis value of the voxel.
+    resid_out : array, (len(b),)
+        Array where the residual is written.
+    jac_out : array, (len(b), 4)
+        Array where the derivatives of the residual with respect to S0, f,
+        D_star and D are written.
+    """
+    cdef double S0 = params[0]
+    cdef double f = params[1]
+    cdef double D_star = params[2]
+    cdef double D = params[3]
+    cdef double scale = D * D * K / 6 - D
+    cdef double bi, e1, e2
+    cdef Py_ssize_t i
+
+    # The loop does not touch Python objects, so other threads can run
+    # while it executes.
+    with nogil:
+        for i in range(b.shape[0]):
+            bi = b[i]
+            e1 = exp(-bi * D_star)
+            e2 = exp(bi * scale)
+            resid_out[i] = signal[i] - S0 * (f * e1 + (1 - f) * e2)
+            jac_out[i, 0] = -(f * e1 + (1 - f) * e2)
+            jac_out[i, 1] = -S0 * (e1 - e2)
+            jac_out[i, 2] = S0 * f * bi * e1
+            jac_out[i, 3] = -S0 * (1 - f) * (bi * D * K / 3 - bi) * e2
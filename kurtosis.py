@@ -1,33 +1,74 @@
+""" Classes and functions for fitting ivim model """
+import itertools
+import math
+import os
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-
-"""Tools to easily make multi voxel models"""
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
-from tqdm import tqdm
+from scipy.optimize import least_squares
 
+from dipy.reconst.base import ReconstModel
 from dipy.reconst.ivim import BOUNDS, f_D_star_error, IvimFit
-from dipy.core.ndindex import ndindex
-from dipy.reconst.quick_squash import quick_squash as _squash
-from dipy.reconst.base import ReconstFit
+from dipy.utils.optpkg import optional_package
 
-""" Classes and functions for fitting ivim model """
-import numpy as np
-from scipy.optimize import least_squares
-import warnings
-from dipy.reconst.base import ReconstModel
-from dipy.reconst.multi_voxel import MultiVoxelFit
+numba, has_numba, _ = optional_package("numba")
+
+# Compiled residual and Jacobian, only available when the Cython extension
+# has been built (see setup.py).
+try:
+    from ._ivim_core import ivim_residual_jac
+    has_ivim_core = True
+except ImportError:
+    has_ivim_core = False
+
+# Scratch arrays of the residual function, one set per thread.
+_scratch = threading.local()
+
+def _fit_one(args):
+    """Fit a single voxel. Defined at module level so that it can be
+    pickled and sent to the workers of a process pool, it is also used by
+    the thread workers.
+    Parameters
+    ----------
+    args : tuple
+        The model instance, the signal of the voxel, its kurtosis value and
+        its linear fit parameters [S0_prime, D, S0, D_star_prime].
+    Returns
+    -------
+    model_params : array
+        The fitted parameters [S0, f, D_star, D] of the voxel.
+    """
+    model, data, dki, linear_params = args
+    return model._fit_voxel(data, dki, linear_params).model_params
 
 
 def multi_voxel_fitDKI(single_voxel_fit):
     """Method decorator to turn a single voxel model fit
     definition into a multi voxel model fit definition
     """
-    def new_fit(self, data, dki_map, mask=None):
-        """Fit method for every voxel in data"""
-        # If only one voxel just return a normal fit
+    def new_fit(self, data, dki_map, mask=None, n_jobs=1,
+                backend='processes'):
+        if backend not in ('processes', 'threads'):
+            raise ValueError("backend must be 'processes' or 'threads'")
+
+        dki_map = np.asarray(dki_map, dtype=np.float32)
+
+        # If only one voxel just return a normal fit, unless it is
+        # background in which case only its S0 is kept.
         if data.ndim == 1:
+            s0_obs = data[self.gtab.b0s_mask].mean()
+            if s0_obs < self.signal_threshold:
+                return IvimFit(self, np.array([s0_obs, np.nan, np.nan,
+                                               np.nan]))
             return single_voxel_fit(self, data, dki_map)
 
+        # Imported here so that single voxel fits, and the workers of the
+        # process pool, do not pay for it.
+        from tqdm import tqdm
+
         # Make a mask if mask is None
         if mask is None:
             shape = data.shape[:-1]
@@ -37,26 +78,88 @@ def multi_voxel_fitDKI(single_voxel_fit):
         elif mask.shape != data.shape[:-1]:
             raise ValueError("mask and data shape do not match")
 
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count() or 1
+
+        mask = np.asarray(mask, dtype=bool)
+        idx = np.argwhere(mask)
+        voxels = data[mask]
+        dmap = dki_map[mask]
+
+        # The parameters of all the voxels are stored in a single array,
+        # voxels outside the mask are left as nan.
+        params = np.full(data.shape[:-1] + (4,), np.nan, dtype=np.float32)
+
+        # Background voxels are not fitted, only their S0 is kept.
+        s0_obs = voxels[:, self.gtab.b0s_mask].mean(axis=-1)
+        background = s0_obs < self.signal_threshold
+        if np.any(background):
+            params[tuple(idx[background].T) + (0,)] = s0_obs[background]
+            idx = idx[~background]
+            voxels = voxels[~background]
+            dmap = dmap[~background]
+
+        # The linear fits of all the voxels are done at once, only the
+        # non-linear refinement is run voxel by voxel.
+        S0_prime, D, S0, D_star_prime = self.estimate_linear_fit_batch(voxels)
+        linear = np.column_stack([S0_prime, D, S0, D_star_prime])
+
+        # When the linear guesses of f and D_star are out of bounds the
+        # non-linear fits cannot start and the linear parameters are
+        # returned, so those voxels skip the refinement altogether.
+        f_guess = 1 - S0_prime / S0
+        feasible = ((f_guess >= 0) & (f_guess <= self.bounds[1][1]) &
+                    (D_star_prime >= 0) & (D_star_prime <= self.bounds[1][2]))
+
+        infeasible = ~feasible
+        if np.any(infeasible):
+            warningMsg = "x0 obtained from linear fitting is not feasible "
+            warningMsg += "for %d voxels. " % np.sum(infeasible)
+            warningMsg += "Returning parameters from linear fit"
+            warnings.warn(warningMsg, UserWarning)
+            params_linear = np.column_stack([S0, f_guess, D_star_prime, D])
+            params[tuple(idx[infeasible].T)] = params_linear[infeasible]
+
+        idx = idx[feasible]
+        voxels = voxels[feasible]
+        dmap = dmap[feasible]
+        linear = linear[feasible]
+
         # Fit data where mask is True
-        fit_array = np.empty(data.shape[:-1], dtype=object)
-        bar = tqdm(total=np.sum(mask), position=0)
-        for ijk in ndindex(data.shape[:-1]):
-            if mask[ijk]:
-                fit_array[ijk] = single_voxel_fit(self, data[ijk], dki_map[ijk])
-                bar.update()
-        bar.close()
-        return MultiVoxelFit(self, fit_array, mask)
+        if n_jobs == 1:
+            results = (self._fit_voxel(*args).model_params
+                       for args in zip(voxels, dmap, linear))
+            results = list(tqdm(results, total=len(voxels), position=0))
+        elif backend == 'threads':
+            with ThreadPoolExecutor(max_workers=n_jobs) as ex:
+                results = list(tqdm(ex.map(_fit_one,
+                                           zip(itertools.repeat(self),
+                                               voxels, dmap, linear)),
+                                    total=len(voxels), position=0))
+        else:
+            chunksize = max(1, len(voxels) // (8 * n_jobs))
+            with ProcessPoolExecutor(max_workers=n_jobs) as ex:
+                results = list(tqdm(ex.map(_fit_one,
+                                           zip(itertools.repeat(self),
+                                               voxels, dmap, linear),
+                                           chunksize=chunksize),
+                                    total=len(voxels), position=0))
+        params[tuple(idx.T)] = np.reshape(results, (-1, 4))
+        return IvimFit(self, params)
+    new_fit.__name__ = single_voxel_fit.__name__
+    new_fit.__qualname__ = single_voxel_fit.__qualname__
+    new_fit.__doc__ = single_voxel_fit.__doc__
     return new_fit
 
 
-def _ivim_error(params, gtab, signal, K):
+def _ivim_error(params, bvals, signal, K):
     """Error function to be used in fitting the IVIM model.
     Parameters
     ----------
     params : array
         An array of IVIM parameters - [S0, f, D_star, D]
-    gtab : GradientTable class instance
-        Gradient directions and bvalues.
+    bvals : array
+        The bvalues.
     signal : array
         Array containing the actual signal values.
     Returns
@@ -64,12 +167,150 @@ def _ivim_error(params, gtab, signal, K):
     residual : array
         An array containing the difference between actual and estimated signal.
     """
-    residual = signal - ivim_prediction(params, K, gtab)
+    pred, tmp = _scratch_buffers(bvals.shape[0])
+    residual = np.subtract(signal, _ivim_signal(params, K, bvals, pred, tmp))
     
     return residual
 
 
-def ivim_prediction(params, K,  gtab):
+def _ivim_residual_loop(params, b, signal, K, out):
+    """Residual of the IVIM model written as a scalar loop over the
+    bvalues, so that it can be compiled with Numba.
+    Parameters
+    ----------
+    params : array
+        An array of IVIM parameters - [S0, f, D_star, D]
+    b : array
+        The bvalues.
+    signal : array
+        Array containing the actual signal values.
+    K : float
+        The kurtosis value of the voxel.
+    out : array
+        Array where the residual is written.
+    """
+    S0 = params[0]
+    f = params[1]
+    D_star = params[2]
+    D = params[3]
+    scale = D * D * K / 6. - D
+    for i in range(b.size):
+        out[i] = signal[i] - S0 * (f * math.exp(-b[i] * D_star) +
+                                   (1 - f) * math.exp(b[i] * scale))
+
+
+if has_numba:
+    _ivim_residual_nb = numba.njit(cache=True, fastmath=True,
+                                   nogil=True)(_ivim_residual_loop)
+
+
+def _ivim_error_nb(params, bvals, signal, K):
+    """Numba compiled version of `_ivim_error`, with the same signature.
+    A new residual array is returned on every call because `least_squares`
+    keeps references to the residuals of previous iterations.
+    """
+    residual = np.empty(signal.shape[0])
+    _ivim_residual_nb(params, bvals, signal, float(K), residual)
+    return residual
+
+
+class _IvimResidualJac(object):
+    """Residual and Jacobian of the IVIM model for one voxel, computed
+    together by the compiled `ivim_residual_jac`.
+    `least_squares` asks for the Jacobian at the point where the residual
+    was last evaluated, so the Jacobian computed along with the residual is
+    kept and returned by `jac`. New arrays are returned on every call
+    because `least_squares` keeps references to the previous ones.
+    """
+    def __init__(self, bvals, signal, K):
+        self.bvals = bvals
+        self.signal = np.ascontiguousarray(signal, dtype=np.float64)
+        self.K = float(K)
+        self._x = None
+        self._jac = None
+
+    def residual(self, params):
+        residual = np.empty(self.bvals.shape[0])
+        jac = np.empty((self.bvals.shape[0], 4))
+        ivim_residual_jac(params, self.bvals, self.signal, self.K,
+                          residual, jac)
+        self._x = params.copy()
+        self._jac = jac
+        return residual
+
+    def jac(self, params):
+        if self._x is None or not np.array_equal(params, self._x):
+            self.residual(params)
+        return self._jac
+
+
+def _ivim_jac(params, bvals, signal, K):
+    """Jacobian of `_ivim_error` with respect to the IVIM parameters.
+    Parameters
+    ----------
+    params : array
+        An array of IVIM parameters - [S0, f, D_star, D]
+    bvals : array
+        The bvalues.
+    signal : array
+        Array containing the actual signal values.
+    K : float
+        The kurtosis value of the voxel.
+    Returns
+    -------
+    jac : array, (len(bvals), 4)
+        The derivatives of the residual with respect to S0, f, D_star and D.
+    """
+    b = bvals
+    S0, f, D_star, D = params
+    e1 = np.exp(-b * D_star)
+    e2 = np.exp(-b * D + (b*D**2)*K/6)
+
+    return -np.column_stack([f * e1 + (1 - f) * e2,
+                             S0 * (e1 - e2),
+                             -S0 * f * b * e1,
+                             S0 * (1 - f) * (-b + b*D*K/3) * e2])
+
+
+def _f_D_star_jac(params, gtab, signal, S0, D):
+    """Jacobian of `f_D_star_error` with respect to f and D_star.
+    Parameters
+    ----------
+    params : array
+        The value of f and D_star.
+    gtab : GradientTable class instance
+        Gradient directions and bvalues.
+    signal : array
+        Array containing the actual signal values.
+    S0 : float
+        The parameters S0 obtained from a linear fit.
+    D : float
+        The parameters D obtained from a linear fit.
+    Returns
+    -------
+    jac : array, (len(bvals), 2)
+        The derivatives of the residual with respect to f and D_star.
+    """
+    b = gtab.bvals
+    f, D_star = params
+    e1 = np.exp(-b * D_star)
+
+    return -np.column_stack([S0 * (e1 - np.exp(-b * D)),
+                             -S0 * f * b * e1])
+
+
+def _scratch_buffers(n):
+    """Two arrays of length `n` to hold intermediate results of the
+    residual function. They are reused by all the residual evaluations of a
+    thread, so the buffers are kept per thread.
+    """
+    buffers = getattr(_scratch, 'buffers', None)
+    if buffers is None or buffers[0].shape[0] != n:
+        buffers = _scratch.buffers = (np.empty(n), np.empty(n))
+    return buffers
+
+
+def ivim_prediction(params, K,  gtab, out=None):
     """The Intravoxel incoherent motion (IVIM) model function.
     Parameters
     ----------
@@ -81,18 +322,86 @@ def ivim_prediction(params, K,  gtab):
         This has been added just for consistency with the existing
         API. Unlike other models, IVIM predicts S0 and this is over written
         by the S0 value in params.
+    out : array, optional
+        Array where the signal is written.
     Returns
     -------
     S : array
         An array containing the IVIM signal estimated using given parameters.
     """
-    b = gtab.bvals
+    return _ivim_signal(params, K, gtab.bvals, out)
+
+
+def _ivim_signal(params, K, b, out=None, tmp=None):
+    """`ivim_prediction` evaluated directly on an array of bvalues `b`,
+    writing the signal to `out` and using `tmp` as scratch space when they
+    are given.
+    """
     S0, f, D_star, D = params
 
+    # -b*D + (b*D**2)*K/6 is folded into a single scaling of b and the
+    # products are accumulated in place to avoid temporary arrays.
+    S = np.multiply(b, -D_star, out=out)
+    np.exp(S, out=S)
+    S *= f
+    e2 = np.multiply(b, D * D * K / 6 - D, out=tmp)
+    np.exp(e2, out=e2)
+    e2 *= 1 - f
+    np.add(S, e2, out=S)
+    S *= S0
+
+    return S
+
+
+def ivim_prediction_batch(params, K, gtab):
+    """The IVIM model function evaluated for many voxels at once.
+    Parameters
+    ----------
+    params : array, (N, 4)
+        An array of IVIM parameters - [S0, f, D_star, D] - for N voxels.
+    K : array, (N,)
+        The kurtosis value of each voxel.
+    gtab : GradientTable class instance
+        Gradient directions and bvalues.
+    Returns
+    -------
+    S : array, (N, len(bvals))
+        The IVIM signal estimated for every voxel using given parameters.
+    """
+    b = gtab.bvals[None, :]
+    params = np.asarray(params)
+    S0 = params[:, 0, None]
+    f = params[:, 1, None]
+    D_star = params[:, 2, None]
+    D = params[:, 3, None]
+    K = np.asarray(K)[:, None]
+
     S = S0 * (f * np.exp(-b * D_star) + (1 - f) * np.exp(-b * D + (b*D**2)*K/6))
 
     return S
 
+
+def _linear_fit_weights(bvals):
+    """Weights of the closed form least squares fit of a straight line to
+    the negative log signal against `bvals`.
+    Parameters
+    ----------
+    bvals : array
+        The b values used in the fit.
+    Returns
+    -------
+    w : array
+        The slope (D) of the fit of `y` is `w @ y`.
+    mean_b : float
+        The mean of `bvals`. The intercept (-log(S0)) of the fit is
+        `y.mean() - D * mean_b`.
+    """
+    bvals = np.asarray(bvals, dtype=float)
+    mean_b = bvals.mean()
+    centered = bvals - mean_b
+    w = centered / (centered ** 2).sum()
+    return w, mean_b
+
 def ivim_model_selector(gtab, fit_method='DKI', **kwargs):
     """
     Selector function to switch between the 2-stage Trust-Region Reflective
@@ -120,9 +429,10 @@ class IvimModelDKI(ReconstModel):
     """Ivim model
     """
     def __init__(self, gtab, split_b_D=400.0, split_b_S0=200., bounds=None,
-                 two_stage=True, tol=1e-15,
+                 two_stage=True, tol=None,
                  x_scale=[1000., 0.1, 0.001, 0.0001],
-                 gtol=1e-15, ftol=1e-15, eps=1e-15, maxiter=1000):
+                 gtol=None, ftol=None, eps=1e-15, maxiter=None,
+                 strict=False, signal_threshold=0.0):
     
         r"""
         Initialize an IVIM model.
@@ -164,25 +474,37 @@ class IvimModelDKI(ReconstModel):
             bvalues. This gives more accurate parameters but takes more time.
             The linear fit can be used to get a quick estimation of the
             parameters. default : False
+        signal_threshold : float, optional
+            Voxels whose mean signal at b == 0 is below this value are
+            considered background and are not fitted: their S0 is set to the
+            mean b == 0 signal and the other parameters to nan. A value of
+            around 5% of the S0 of the tissue skips most of the voxels
+            outside of the head. default : 0.
         tol : float, optional
             Tolerance for convergence of minimization.
-            default : 1e-15
+            default : 1e-8 (1e-15 if `strict`)
         x_scale : array, optional
             Scaling for the parameters. This is passed to `least_squares` which
             is only available for Scipy version > 0.17.
             default: [1000, 0.01, 0.001, 0.0001]
         gtol : float, optional
             Tolerance for termination by the norm of the gradient.
-            default : 1e-15
+            default : 1e-8 (1e-15 if `strict`)
         ftol : float, optional
             Tolerance for termination by the change of the cost function.
-            default : 1e-15
+            default : 1e-8 (1e-15 if `strict`)
         eps : float, optional
             Step size used for numerical approximation of the jacobian.
             default : 1e-15
         maxiter : int, optional
             Maximum number of iterations to perform.
-            default : 1000
+            default : 100 (1000 if `strict`)
+        strict : bool, optional
+            If True, the defaults of `tol`, `gtol`, `ftol` and `maxiter` are
+            the previous, much stricter, stopping criteria. These only make
+            the fits slower on real data, since the looser defaults are
+            already well below the noise level of the signal, and are kept
+            for regression testing. default : False
         References
         ----------
         .. [1] Le Bihan, Denis, et al. "Separation of diffusion and perfusion
@@ -212,12 +534,44 @@ class IvimModelDKI(ReconstModel):
         self.split_b_S0 = split_b_S0
         self.bounds = bounds
         self.two_stage = two_stage
+        self.signal_threshold = signal_threshold
+        if strict:
+            default_tol, default_maxiter = 1e-15, 1000
+        else:
+            default_tol, default_maxiter = 1e-8, 100
+        tol = default_tol if tol is None else tol
+        gtol = default_tol if gtol is None else gtol
+        ftol = default_tol if ftol is None else ftol
+        maxiter = default_maxiter if maxiter is None else maxiter
+
         self.tol = tol
         self.options = {'gtol': gtol, 'ftol': ftol,
                         'eps': eps, 'maxiter': maxiter}
         self.x_scale = x_scale
 
-        self.bounds = bounds or BOUNDS
+        # The bounds are kept as plain tuples of floats, which makes the
+        # per voxel bounds check below cheaper than with NumPy arrays.
+        lower, upper = bounds or BOUNDS
+        self.bounds = (tuple(float(v) for v in lower),
+                       tuple(float(v) for v in upper))
+
+        # The b-value splits are fixed for the model, so the masks and the
+        # weights of the closed form linear fits are computed once.
+        # The bvalues are also cached as contiguous arrays: float64 for the
+        # NumPy residual functions, so that they are evaluated in double
+        # precision whatever the NumPy promotion rules, and float32 for the
+        # compiled kernels, which compute in double precision internally.
+        self._b = np.ascontiguousarray(gtab.bvals, dtype=np.float64)
+        self._b32 = self._b.astype(np.float32)
+        bvals = self._b
+        self._split_hi = split_b_D
+        self._split_lo = split_b_S0
+        self._m_hi = bvals >= split_b_D
+        self._b_hi = bvals[self._m_hi]
+        self._w_hi, self._mb_hi = _linear_fit_weights(self._b_hi)
+        self._m_lo = bvals <= split_b_S0
+        self._b_lo = bvals[self._m_lo]
+        self._w_lo, self._mb_lo = _linear_fit_weights(self._b_lo)
 
     @multi_voxel_fitDKI
     def fit(self, data, dki_map):
@@ -235,23 +589,61 @@ class IvimModelDKI(ReconstModel):
         Parameters
         ----------
         data : array
-            The measured signal from one voxel. A multi voxel decorator
-            will be applied to this fit method to scale it and apply it
-            to multiple voxels.
+            The measured signal from one voxel, or from multiple voxels with
+            the bvalues along the last axis.
+        dki_map : float or array
+            The kurtosis value of the voxel, or a map of kurtosis values with
+            the shape of `data` without its last axis.
+        mask : array, optional
+            A boolean array of the shape of `data` without its last axis,
+            only the voxels where it is True are fitted. default : None
+        n_jobs : int, optional
+            Number of workers used to fit the voxels. If 1 the voxels are
+            fitted serially; if None or -1 all the available cores are used.
+            default : 1
+        backend : string, optional
+            Either 'processes' or 'threads'. Threads do not need to pickle
+            the model and the data for the workers, but they are not
+            expected to scale with `n_jobs`: only the Cython and Numba
+            residuals release the GIL, while the iterations of the
+            `least_squares` solver run in Python and hold it.
+            default : 'processes'
+        Returns
+        -------
+        IvimFit object
+        """
+        return self._fit_voxel(data, dki_map)
+
+    def _fit_voxel(self, data, dki_map, linear_params=None):
+        """Fit a single voxel, see `fit`.
+        Parameters
+        ----------
+        data : array
+            The measured signal from one voxel.
+        dki_map : float
+            The kurtosis value of the voxel.
+        linear_params : array, optional
+            The parameters [S0_prime, D, S0, D_star_prime] of the linear fits,
+            if they have already been estimated (see
+            `estimate_linear_fit_batch`).
         Returns
         -------
         IvimFit object
         """
-        # Get S0_prime and D - parameters assuming a single exponential decay
-        # for signals for bvals greater than `split_b_D`
-        S0_prime, D = self.estimate_linear_fit(
-            data, self.split_b_D, less_than=False)
+        if linear_params is not None:
+            S0_prime, D, S0, D_star_prime = linear_params
+        else:
+            # Get S0_prime and D - parameters assuming a single exponential
+            # decay for signals for bvals greater than `split_b_D`
+            S0_prime, D = self.estimate_linear_fit(
+                data, self.split_b_D, less_than=False)
 
-        # Get S0 and D_star_prime - parameters assuming a single exponential
-        # decay for for signals for bvals greater than `split_b_S0`.
+            # Get S0 and D_star_prime - parameters assuming a single
+            # exponential decay for for signals for bvals greater than
+            # `split_b_S0`.
 
-        S0, D_star_prime = self.estimate_linear_fit(data, self.split_b_S0,
-                                                    less_than=True)
+            S0, D_star_prime = self.estimate_linear_fit(data, self.split_b_S0,
+                                                        less_than=True)
         # Estimate f
         f_guess = 1 - S0_prime / S0
 
@@ -262,8 +654,11 @@ class IvimModelDKI(ReconstModel):
         # Fit parameters again if two_stage flag is set.
         if self.two_stage:
             params_two_stage = self._leastsq(data, dki_map, params_linear)
-            bounds_violated = ~(np.all(params_two_stage >= self.bounds[0]) and
-                                (np.all(params_two_stage <= self.bounds[1])))
+            # A nan parameter also counts as a violation.
+            bounds_violated = not all(
+                lo <= p <= hi for lo, p, hi in zip(self.bounds[0],
+                                                   params_two_stage.tolist(),
+                                                   self.bounds[1]))
             
             if bounds_violated:
                 warningMsg = "Bounds are violated for leastsq fitting. "
@@ -292,23 +687,55 @@ class IvimModelDKI(ReconstModel):
         D : float
             The estimated value of D.
         """
-        if less_than:
-            bvals_split = self.gtab.bvals[self.gtab.bvals <= split_b]
-            D, neg_log_S0 = np.polyfit(bvals_split,
-                                       -np.log(data[self.gtab.bvals <=
-                                                    split_b]), 1)
+        if less_than and split_b == self._split_lo:
+            mask, w, mean_b = self._m_lo, self._w_lo, self._mb_lo
+        elif not less_than and split_b == self._split_hi:
+            mask, w, mean_b = self._m_hi, self._w_hi, self._mb_hi
         else:
-            bvals_split = self.gtab.bvals[self.gtab.bvals >= split_b]
-            D, neg_log_S0 = np.polyfit(bvals_split,
-                                       -np.log(data[self.gtab.bvals >=
-                                                    split_b]), 1)
+            bvals = self._b
+            mask = bvals <= split_b if less_than else bvals >= split_b
+            w, mean_b = _linear_fit_weights(bvals[mask])
+        y = -np.log(data[mask])
+        D = w @ y
+        neg_log_S0 = y.mean() - D * mean_b
 
         S0 = np.exp(-neg_log_S0)
         return S0, D
 
+    def estimate_linear_fit_batch(self, data):
+        """Estimate the linear fits of many voxels at once.
+        Parameters
+        ----------
+        data : array, (N, len(bvals))
+            An array containing the signal of N voxels.
+        Returns
+        -------
+        S0_prime : array, (N,)
+            The intercept of the fit for bvals >= `split_b_D`.
+        D : array, (N,)
+            The estimated value of D.
+        S0 : array, (N,)
+            The intercept of the fit for bvals <= `split_b_S0`.
+        D_star_prime : array, (N,)
+            The initial guess for D_star.
+        """
+        y = -np.log(data[:, self._m_hi])
+        D = y @ self._w_hi
+        neg_log_S0_prime = y.mean(axis=-1) - D * self._mb_hi
+        y = -np.log(data[:, self._m_lo])
+        D_star_prime = y @ self._w_lo
+        neg_log_S0 = y.mean(axis=-1) - D_star_prime * self._mb_lo
+        return np.exp(-neg_log_S0_prime), D, np.exp(-neg_log_S0), D_star_prime
+
     def estimate_f_D_star(self, params_f_D_star, data, S0, D):
         """Estimate f and D_star using the values of all the other parameters
         obtained from a linear fit.
+        The fit is first done with the Levenberg-Marquardt method, which is
+        cheaper per iteration than Trust-Region Reflective but does not
+        support bounds. The bounds on f and D_star are rarely active, so the
+        bounded Trust-Region Reflective fit is only run when the
+        Levenberg-Marquardt solution falls outside of them. The two methods
+        can stop at slightly different points within the tolerances.
         Parameters
         ----------
         params_f_D_star: array
@@ -330,12 +757,29 @@ class IvimModelDKI(ReconstModel):
         ftol = self.options["ftol"]
         xtol = self.tol
         maxfev = self.options["maxiter"]
+        lb = (0., 0.)
+        ub = (self.bounds[1][1], self.bounds[1][2])
 
         try:
+            f, D_star = params_f_D_star
+            if lb[0] <= f <= ub[0] and lb[1] <= D_star <= ub[1]:
+                res = least_squares(f_D_star_error,
+                                    params_f_D_star,
+                                    jac=_f_D_star_jac,
+                                    method='lm',
+                                    args=(self.gtab, data, S0, D),
+                                    ftol=ftol,
+                                    xtol=xtol,
+                                    gtol=gtol,
+                                    max_nfev=maxfev)
+                f, D_star = res.x
+                if lb[0] <= f <= ub[0] and lb[1] <= D_star <= ub[1]:
+                    return f, D_star
+
             res = least_squares(f_D_star_error,
                                 params_f_D_star,
-                                bounds=((0., 0.), (self.bounds[1][1],
-                                                   self.bounds[1][2])),
+                                jac=_f_D_star_jac,
+                                bounds=(lb, ub),
                                 args=(self.gtab, data, S0, D),
                                 ftol=ftol,
                                 xtol=xtol,
@@ -396,16 +840,23 @@ class IvimModelDKI(ReconstModel):
         xtol = self.tol
         maxfev = self.options["maxiter"]
         bounds = self.bounds
+        if has_ivim_core:
+            residual_jac = _IvimResidualJac(self._b32, data, dki_map)
+            error, jac, args = residual_jac.residual, residual_jac.jac, ()
+        else:
+            error = _ivim_error_nb if has_numba else _ivim_error
+            jac, args = _ivim_jac, (self._b, data, dki_map)
 
         try:
-            res = least_squares(_ivim_error,
+            res = least_squares(error,
                                 x0,
+                                jac=jac,
                                 bounds=bounds,
                                 ftol=ftol,
                                 xtol=xtol,
                                 gtol=gtol,
                                 max_nfev=maxfev,
-                                args=(self.gtab, data, dki_map),
+                                args=args,
                                 x_scale=self.x_scale)
             ivim_params = res.x
             if np.all(np.isnan(ivim_params)):
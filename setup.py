@@ -1,4 +1,16 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
+
+# The compiled residual of the IVIM model is optional, kurtosis.py falls
+# back to Numba or NumPy when it is not built.
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules = []
+else:
+    ext_modules = cythonize([
+        Extension("kurtosis._ivim_core", ["_ivim_core.pyx"],
+                  extra_compile_args=["-O3"]),
+    ])
 
 setup(
     name='IVIM Kurtosis Implementation',
@@ -9,4 +21,5 @@ setup(
         "kurtosis": "./",
 
     },
+    ext_modules=ext_modules,
 )